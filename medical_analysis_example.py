@@ -1,11 +1,15 @@
 import pandas as pd
-from openai import OpenAI, APIError, APIConnectionError
+from openai import AsyncOpenAI, APIError, APIConnectionError
 from tqdm import tqdm
-import concurrent.futures
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import asyncio
+import json
+from collections import deque
+from tenacity import (AsyncRetrying, stop_after_attempt, wait_exponential,
+                      retry_if_exception_type, before_sleep_log)
 import time
 import logging
 import os 
+import zlib
 
 # Configure logging
 logging.basicConfig(
@@ -18,13 +22,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def create_client():
-    """Create OpenAI client with configuration"""
-    return OpenAI(
-        base_url="",
-        api_key="",
-        timeout=60
-    )
+# Prefer the Rust-based calamine reader when installed and supported by
+# pandas (engine added in pandas 2.2); openpyxl otherwise
+try:
+    import python_calamine  # noqa: F401
+    PANDAS_VERSION = tuple(int(part) for part in pd.__version__.split(".")[:2])
+    EXCEL_ENGINE = "calamine" if PANDAS_VERSION >= (2, 2) else "openpyxl"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+# Shared OpenAI client, reused across cases to keep connections warm.
+# SDK retries are disabled so the tenacity policy is the only retry layer.
+client = AsyncOpenAI(
+    base_url="",
+    api_key="",
+    timeout=60,
+    max_retries=0
+)
+
+class RateLimiter:
+    """Async limiter allowing at most max_calls per period seconds"""
+
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a call slot is free, then claim it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self._calls[0]))
+
+# Input columns read by build_prompt/success_result; others are never loaded
+INPUT_COLUMNS = {"AGE", "SEX", "chief complaint", "present history",
+                 "past history", "DAY", "CTA"}
+
+# Maximum characters of long free-text fields sent to the model
+FIELD_LIMITS = {"CTA": 2000}
+
+RESULT_COLUMNS = ("index", "gender", "age", "surgery_date", "model_output",
+                  "has_format_warning", "status", "attempt_count", "error_log")
 
 PROMPT_TEMPLATE = '''
 You are a cardiac intervention specialist. Based on the patient's clinical data and coronary CTA report, 
@@ -33,15 +78,15 @@ cardiovascular intervention guidelines before the patient's surgery date, and re
 Please follow the process strictly:
 
 **Patient Information**
-Age: <age>{{AGE}}</age>
-Gender: <gender>{{GENDER}}</gender>
-Chief Complaint: <chief complaint>{{CHIEF COMPLAINT}}</chief complaint>
-Present History: <present history>{{PRESENT HISTORY}}</present history>
-Past History: <past history>{{PAST HISTORY}}</past history>
-Surgery Date: <day>{{DAY}}</day>
+Age: <age>{AGE}</age>
+Gender: <gender>{GENDER}</gender>
+Chief Complaint: <chief complaint>{CHIEF COMPLAINT}</chief complaint>
+Present History: <present history>{PRESENT HISTORY}</present history>
+Past History: <past history>{PAST HISTORY}</past history>
+Surgery Date: <day>{DAY}</day>
 Coronary CTA Report:
 <CTA>
-{{CORONARY_CTA}}
+{CORONARY_CTA}
 </CTA>
 
 **Analysis Process**
@@ -84,100 +129,261 @@ Reason: [Combined with lesion characteristics]
 </recommendation>
 '''
 
-@retry(stop=stop_after_attempt(5),
-       wait=wait_exponential(multiplier=1, min=2, max=60),
-       retry=retry_if_exception_type((APIError, APIConnectionError)))
-def api_call_with_retry(client, prompt):
-    """Make API call with retry mechanism"""
-    return client.chat.completions.create(
-        model="o3-mini",
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=5000
-    )
+def build_prompt(row):
+    """Fill the prompt template with a single case's data"""
+    return PROMPT_TEMPLATE.format_map({
+        "AGE": str(row.get('AGE', 'Unknown')),
+        "GENDER": str(row.get('SEX', 'Unknown')),
+        "CHIEF COMPLAINT": str(row.get('chief complaint', 'Unknown')),
+        "PRESENT HISTORY": str(row.get('present history', 'Unknown')),
+        "PAST HISTORY": str(row.get('past history', 'Unknown')),
+        "DAY": str(row.get('DAY', 'Unknown')),
+        "CORONARY_CTA": str(row.get('CTA', 'Unknown'))
+    })
+
+def completion_request(prompt):
+    """Chat completion parameters shared by direct and batch calls"""
+    return {
+        "model": "o3-mini",
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": 5000
+    }
 
-def process_case(args):
-    """Process a single medical case"""
-    index, row = args
-    client = create_client()
-    error_logs = []
-
-    processed_prompt = PROMPT_TEMPLATE \
-        .replace("{{AGE}}", str(row.get('AGE', 'Unknown'))) \
-        .replace("{{GENDER}}", str(row.get('SEX', 'Unknown'))) \
-        .replace("{{CHIEF COMPLAINT}}", str(row.get('chief complaint', 'Unknown'))) \
-        .replace("{{PRESENT HISTORY}}", str(row.get('present history', 'Unknown'))) \
-        .replace("{{PAST HISTORY}}", str(row.get('past history', 'Unknown'))) \
-        .replace("{{DAY}}", str(row.get('DAY', 'Unknown'))) \
-        .replace("{{CORONARY_CTA}}", str(row.get('CTA', 'Unknown'))[:2000])
-
-    for attempt in range(3):
-        try:
-            response = api_call_with_retry(client, processed_prompt)
-            raw_content = response.choices[0].message.content
-            if raw_content.strip():
-                cleaned_content = raw_content.replace("</decision>", "</decision>") \
-                    .replace("</recommendation>", "</recommendation>")
-
-                format_warning = ""
-                if not all(tag in cleaned_content for tag in ["<decision>", "<recommendation>"]):
-                    format_warning = "(Format Warning: Missing Required Tags)"
-                elif not all(tag in cleaned_content for tag in ["</decision>", "</recommendation>"]):
-                    format_warning = "(Format Warning: Unclosed Tags)"
-
-                return {
-                    "index": index,
-                    "gender": row['SEX'],
-                    "age": row['AGE'],
-                    "surgery_date": row['DAY'],
-                    "model_output": f"{cleaned_content}{format_warning}",
-                    "status": "success",
-                    "attempt_count": attempt + 1
-                }
-            raise ValueError("Empty Response")
+def success_result(index, row, raw_content, attempt_count):
+    """Build the result record for a case with a model response"""
+    cleaned_content = raw_content.replace("</decision>", "</decision>") \
+        .replace("</recommendation>", "</recommendation>")
 
-        except Exception as e:
-            error_logs.append(f"Attempt {attempt + 1}: {type(e).__name__} - {str(e)}")
-            if "rate limit" in str(e).lower():
-                time.sleep(15)
-            continue
+    format_warning = ""
+    if not all(tag in cleaned_content for tag in ["<decision>", "<recommendation>"]):
+        format_warning = "(Format Warning: Missing Required Tags)"
+    elif not all(tag in cleaned_content for tag in ["</decision>", "</recommendation>"]):
+        format_warning = "(Format Warning: Unclosed Tags)"
 
-    logger.error(f"Case {index} failed: {'; '.join(error_logs)}")
+    return {
+        "index": index,
+        "gender": row.get('SEX'),
+        "age": row.get('AGE'),
+        "surgery_date": row.get('DAY'),
+        "model_output": f"{cleaned_content}{format_warning}",
+        "has_format_warning": bool(format_warning),
+        "status": "success",
+        "attempt_count": attempt_count
+    }
+
+def failed_result(index, error):
+    """Build the result record for a case that could not be analysed"""
+    logger.error(f"Case {index} failed: {error}")
     return {
         "index": index,
         "status": "failed",
-        "error_log": error_logs[-1] if error_logs else "Unknown Error"
+        "error_log": error
     }
 
+def api_retrying():
+    """Retry policy shared by all API calls"""
+    return AsyncRetrying(
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(multiplier=1, min=2, max=60),
+        retry=retry_if_exception_type((APIError, APIConnectionError, ValueError)),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True
+    )
+
+async def api_call(prompt, limiter):
+    """Make a single API call and return the response text"""
+    # One limiter slot per HTTP request; holds because the client has max_retries=0
+    await limiter.acquire()
+    response = await client.chat.completions.create(**completion_request(prompt))
+    raw_content = response.choices[0].message.content
+    if not raw_content or not raw_content.strip():
+        raise ValueError("Empty Response")
+    return raw_content
+
+async def process_case(limiter, index, row):
+    """Process a single medical case"""
+    processed_prompt = build_prompt(row)
+
+    try:
+        async for attempt in api_retrying():
+            with attempt:
+                raw_content = await api_call(processed_prompt, limiter)
+
+    except Exception as e:
+        return failed_result(index, f"{type(e).__name__} - {str(e)}")
+
+    return success_result(index, row, raw_content, attempt.retry_state.attempt_number)
+
+async def run_cases(df, config):
+    """Process all cases concurrently"""
+    limiter = RateLimiter(config["max_requests"], config["rate_limit_period"])
+    semaphore = asyncio.Semaphore(config["max_concurrency"])
+
+    async def bounded(index, row):
+        async with semaphore:
+            return await process_case(limiter, index, row)
+
+    # Plain dicts avoid building a pandas Series per row
+    tasks = [bounded(idx, row) for idx, row in zip(df.index, df.to_dict("records"))]
+    results = []
+
+    with tqdm(total=len(tasks), desc="Medical Analysis Progress") as progress:
+        for future in asyncio.as_completed(tasks):
+            results.append(await future)
+            progress.update(1)
+
+    return results
+
+async def run_batch(df, config):
+    """Process all cases as a single Batch API job"""
+    if not hasattr(client, "batches"):
+        raise RuntimeError("use_batch_api requires an openai release with Batch API "
+                           "support; upgrade with: pip install -U openai")
+
+    cases = {str(idx): (idx, row) for idx, row in zip(df.index, df.to_dict("records"))}
+
+    lines = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": completion_request(build_prompt(row))
+        }, ensure_ascii=False)
+        for custom_id, (idx, row) in cases.items()
+    ]
+    input_file = await client.files.create(
+        file=("batch_input.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    logger.info(f"Submitted batch {batch.id} with {len(lines)} cases")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(config["batch_poll_interval"])
+        # A transient outage must not abandon a batch that is still running
+        try:
+            async for attempt in api_retrying():
+                with attempt:
+                    batch = await client.batches.retrieve(batch.id)
+        except (APIError, APIConnectionError) as e:
+            logger.warning(f"Polling batch {batch.id} failed, will retry: {str(e)}")
+            continue
+        logger.info(f"Batch {batch.id} status: {batch.status}")
+
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        try:
+            async for attempt in api_retrying():
+                with attempt:
+                    content = await client.files.content(file_id)
+        except (APIError, APIConnectionError) as e:
+            logger.error(f"Downloading {file_id} of batch {batch.id} failed: {str(e)}")
+            continue
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            case = cases.get(item.get("custom_id"))
+            if case is None:
+                logger.warning(f"Skipping batch result with unknown custom_id: {item.get('custom_id')}")
+                continue
+            idx, row = case
+            response = item.get("response") or {}
+            body = response.get("body") or {}
+            if response.get("status_code") == 200:
+                try:
+                    raw_content = body["choices"][0]["message"]["content"]
+                except (KeyError, IndexError, TypeError) as e:
+                    results[idx] = failed_result(idx, f"Malformed batch response - {str(e)}")
+                    continue
+                if raw_content and raw_content.strip():
+                    results[idx] = success_result(idx, row, raw_content, 1)
+                    continue
+                results[idx] = failed_result(idx, "ValueError - Empty Response")
+            else:
+                error = item.get("error") or body.get("error") or "Unknown Error"
+                results[idx] = failed_result(idx, str(error))
+
+    for idx, row in cases.values():
+        if idx not in results:
+            results[idx] = failed_result(idx, f"Batch {batch.status} without a result")
+
+    return list(results.values())
+
+async def run_and_close(runner, df, config):
+    """Run the cases and close the shared client before the loop shuts down"""
+    try:
+        return await runner(df, config)
+    finally:
+        await client.close()
+
+def read_cases(input_path):
+    """Read the input columns of the case sheet"""
+    return pd.read_excel(
+        input_path,
+        engine=EXCEL_ENGINE,
+        usecols=lambda col: col in INPUT_COLUMNS
+    ).convert_dtypes()
+
+def load_cases(input_path, use_cache=False):
+    """Load the case sheet, optionally reusing an up-to-date parquet copy"""
+    if not use_cache:
+        return read_cases(input_path)
+
+    # The cache only holds INPUT_COLUMNS, so key it on that set as well as
+    # the workbook mtime; changing the columns then forces a fresh read
+    columns_key = zlib.crc32("\n".join(sorted(INPUT_COLUMNS)).encode("utf-8"))
+    cache_path = f"{os.path.splitext(input_path)[0]}.{columns_key:08x}.parquet"
+
+    if os.path.exists(cache_path) and \
+            os.path.getmtime(cache_path) >= os.path.getmtime(input_path):
+        try:
+            return pd.read_parquet(cache_path)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache {cache_path}: {str(e)}")
+
+    df = read_cases(input_path)
+
+    try:
+        df.to_parquet(cache_path)
+        logger.info(f"Cached input data to: {cache_path}")
+    except Exception as e:
+        logger.warning(f"Could not cache input data as parquet: {str(e)}")
+
+    return df
+
 def main():
     """Main execution function"""
     config = {
         "input_path": "END.xlsx",
         "output_path": "medical_analysis_results.xlsx",
-        "max_workers": 1,
-        "rate_limit_delay": 150
+        "max_concurrency": 32,
+        "max_requests": 20,
+        "rate_limit_period": 150,
+        "use_batch_api": False,
+        "batch_poll_interval": 60,
+        "cache_input": False
     }
 
-    df = pd.read_excel(config["input_path"]).convert_dtypes()
+    df = load_cases(config["input_path"], config["cache_input"])
     logger.info(f"Successfully loaded {len(df)} cases")
 
-    with concurrent.futures.ThreadPoolExecutor(
-            max_workers=config["max_workers"]
-    ) as executor:
-        futures = []
-        results = []
-
-        for idx, row in df.iterrows():
-            future = executor.submit(process_case, (idx, row))
-            futures.append(future)
+    # Truncate long fields once for the whole column rather than per case
+    for col, limit in FIELD_LIMITS.items():
+        if col in df.columns:
+            df[col] = df[col].astype("string").fillna("Unknown").str.slice(0, limit)
 
-        with tqdm(total=len(futures), desc="Medical Analysis Progress") as progress:
-            for future in concurrent.futures.as_completed(futures):
-                results.append(future.result())
-                progress.update(1)
-                if len(results) % 20 == 0:
-                    time.sleep(config["rate_limit_delay"])
+    runner = run_batch if config["use_batch_api"] else run_cases
+    results = asyncio.run(run_and_close(runner, df, config))
 
-    result_df = pd.DataFrame(results).sort_values("index")
+    # Fixed schema keeps every column present even if all cases failed
+    result_df = pd.DataFrame.from_records(results, columns=RESULT_COLUMNS).sort_values("index")
 
     try:
         output_path = os.path.abspath(config["output_path"])
@@ -210,7 +416,7 @@ def main():
 
     # Generate Analysis Report
     success_count = result_df[result_df['status'] == 'success'].shape[0]
-    format_warnings = result_df['model_output'].str.contains("Format Warning").sum()
+    format_warnings = result_df['has_format_warning'].eq(True).sum()
 
     logger.info("\nAnalysis Report:")
     logger.info(f"Success Rate: {success_count / len(df):.1%}")